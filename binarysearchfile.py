@@ -21,18 +21,39 @@ Byte offset length
 """
 
 
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass
+from heapq import merge
+from itertools import islice, repeat
+import mmap
 import os.path
+import shutil
+import struct
+import tempfile
 from warnings import warn
 
 
 __version__ = '0.2.0'
 
+# number of records read or written at once in bulk operations
+CHUNKSIZE = 2 ** 16
 
-def _rint(f, l):
-    return int.from_bytes(f.read(l))
+
+_U16 = struct.Struct('>H')
+# metaoffset and dataoffset
+_OFFSETS = struct.Struct('>HH')
+# mtime, size, inode, dataoffset and recsize of the data file
+# at the start of key index files
+_KEYIDX = struct.Struct('>qqqqq')
+
+
+def _parse_meta(meta):
+    """Return number of fields, field types and sizes from metadata block"""
+    reclen, = _U16.unpack_from(meta)
+    flat = struct.unpack_from('>' + 'BH' * reclen, meta, 2)
+    return reclen, list(flat[0::2]), list(flat[1::2])
 
 
 def _humanb(size, p=2):
@@ -45,20 +66,37 @@ def _humanb(size, p=2):
 
 
 def _binarysearch(f, x, hi, left=True):
+    # Shar's algorithm, lo grows by decreasing powers of two
     lo = 0
-    while lo < hi:
-        mid = (lo+hi)//2
-        if left and f(mid) < x or (not left and not x < f(mid)):
-            lo = mid+1
-        else:
-            hi = mid
+    step = 1 << (hi.bit_length() - 1) if hi else 0
+    while step:
+        if lo + step <= hi:
+            v = f(lo + step - 1)
+            lo += step * (v < x if left else not x < v)
+        step >>= 1
     return lo - (left == False)
 
 
+def _madvise(mm, option, start=0, length=None):
+    # madvise is not available on all platforms
+    if hasattr(mmap, option):
+        if length is None:
+            mm.madvise(getattr(mmap, option))
+        else:
+            # start needs to be aligned to pages
+            offset = start % mmap.PAGESIZE
+            mm.madvise(getattr(mmap, option), start - offset, length + offset)
+
+
 def _byte_length(v):
     return (v.bit_length() + 7) // 8
 
 
+# struct format characters for ints which fit into a machine type
+_STRUCT_INT = {(50, 1): 'B', (50, 2): 'H', (50, 4): 'I', (50, 8): 'Q',
+               (51, 1): 'b', (51, 2): 'h', (51, 4): 'i', (51, 8): 'q'}
+
+
 DTypeDef = namedtuple('DType', ['name', 'len', 'encode', 'decode'])
 DTYPE = {
      0: DTypeDef('byte_ljust', len,
@@ -69,10 +107,10 @@ DTYPE = {
                 decode=lambda v: v.rstrip(b' ').decode('latin1')),
     20: DTypeDef('utf-8_ljust', lambda v: len(v.encode('utf-8')),
                 encode=lambda v, s: v.encode('utf-8').ljust(s, b' '),
-                decode=lambda v: v.rstrip(b' ').decode('utf-8')),
+                decode=lambda v: v.rstrip(b' ').decode()),
     50: DTypeDef('int', _byte_length,
                  encode=lambda v, s: v.to_bytes(s),
-                 decode=lambda v: int.from_bytes(v)),
+                 decode=int.from_bytes),
     51: DTypeDef('signedint', lambda v: _byte_length(2 * abs(v)),
                  encode=lambda v, s: v.to_bytes(s, signed=True),
                  decode=lambda v: int.from_bytes(v, signed=True))
@@ -87,6 +125,8 @@ class _Attr:
     recsize: int = None
     dataoffset: int = None
     metaoffset: int = None
+    # file size cached while the file is opened read-only
+    filesize: int = None
 
     @property
     def len(self):
@@ -97,7 +137,9 @@ class _Attr:
 
     @property
     def totalsize(self):
-        return os.path.getsize(self.fname)
+        if self.filesize is None:
+            return os.path.getsize(self.fname)
+        return self.filesize
 
 
 class BinarySearchFile():
@@ -110,21 +152,65 @@ class BinarySearchFile():
     #   2B offset to data
     headerstart = b'BinarySearchFile'
     record = (10, 50)
+    # build an in-memory index of all keys on first search,
+    # speeds up repeated searches with the same object,
+    # use 'file' to additionally store the key column in a file beside
+    # the data file and load it from there in later sessions
+    keyindex = False
 
     def __init__(self, fname):
         self.f = None
+        self.mm = None
         self.header = None
         self.size = None
         self.attr = _Attr(fname=fname)
+        self._keys = None
+
+    def __enter__(self):
+        self.open()
+        try:
+            self.read_header()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def open(self):
+        """Open file for several queries, otherwise each query opens it"""
+        if self.f is not None:
+            return
+        self.f = open(self.attr.fname, 'rb')
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.close()
+            raise
+        # no readahead, binary search accesses records randomly
+        _madvise(self.mm, 'MADV_RANDOM')
+        self.attr.filesize = os.fstat(self.f.fileno()).st_size
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        if self.f is not None:
+            self.f.close()
+        self.f = None
+        self.mm = None
+        self.attr.filesize = None
 
     @contextmanager
     def _open(self):
         if self.f is not None:
             yield self.f
         else:
-            with open(self.attr.fname, 'rb') as self.f:
+            self.open()
+            try:
                 yield self.f
-            self.f = None
+            finally:
+                self.close()
 
     @classmethod
     def check_magic(cls, fname, n=1):
@@ -152,18 +238,15 @@ class BinarySearchFile():
                 if not self._check_magic():
                     warn(f'Wrong magic bytes in file {self.attr.fname}')
                 # overide class attributes
-                self.attr.metaoffset = _rint(f, 2)
-                self.attr.dataoffset = _rint(f, 2)
+                self.attr.metaoffset, self.attr.dataoffset = _OFFSETS.unpack(
+                    f.read(_OFFSETS.size))
                 self.header = f.read(
                     self.attr.metaoffset - len(self.magic) - 4)
-                assert f.tell() == self.attr.metaoffset
-                self.attr.reclen = _rint(f, 2)
-                self.record = []
-                self.size = []
-                for i in range(self.attr.reclen):
-                    self.record.append(_rint(f, 1))
-                    self.size.append(_rint(f, 2))
+                meta = f.read(self.attr.dataoffset - self.attr.metaoffset)
+                self.attr.reclen, self.record, self.size = _parse_meta(meta)
                 self.attr.recsize = sum(self.size)
+                self._struct, _, self._decoders = self._codecs(self.size)
+                self._keystruct = self._codecs(self.size[:1])[0]
             if not self._sizecheck():
                 warn(f'The size of file {self.attr.fname} is inconsistent')
         return self.header
@@ -175,19 +258,109 @@ class BinarySearchFile():
     def _sizecheck(self):
         return self.attr.dataoffset + self.attr.len * self.attr.recsize == self.attr.totalsize
 
-    def _get_key(self, i=None):
-        """Get record key i or the key of the next record"""
-        if i is not None:
-            self.f.seek(self.attr.dataoffset + i * self.attr.recsize)
-        bytes_ = self.f.read(self.size[0])
-        return self.DTYPE[self.record[0]].decode(bytes_)
-
-    def _get_data(self, i=None):
-        """Get record i or the next record"""
-        if i is not None:
-            self.f.seek(self.attr.dataoffset + i * self.attr.recsize)
-        return tuple(self.DTYPE[record].decode(self.f.read(size))
-                     for record, size in zip(self.record, self.size))
+    def _codecs(self, size):
+        """Return record struct and encoders and decoders of all fields
+
+        Ints with 1, 2, 4 or 8 bytes are handled by struct directly,
+        their encoder and decoder is None."""
+        fmt = '>'
+        encoders = []
+        decoders = []
+        for num, s in zip(self.record, size):
+            dtype = self.DTYPE[num]
+            if dtype is DTYPE.get(num) and (num, s) in _STRUCT_INT:
+                fmt += _STRUCT_INT[num, s]
+                encoders.append(None)
+                decoders.append(None)
+            else:
+                fmt += f'{s}s'
+                encoders.append(dtype.encode)
+                decoders.append(dtype.decode)
+        return struct.Struct(fmt), encoders, decoders
+
+    def _get_key(self, i):
+        """Get key of record i"""
+        base = self.attr.dataoffset + i * self.attr.recsize
+        key, = self._keystruct.unpack_from(self.mm, base)
+        decode = self._decoders[0]
+        return key if decode is None else decode(key)
+
+    def _get_data(self, i):
+        """Get record i"""
+        base = self.attr.dataoffset + i * self.attr.recsize
+        fields = self._struct.unpack_from(self.mm, base)
+        return tuple(v if decode is None else decode(v)
+                     for decode, v in zip(self._decoders, fields))
+
+    def _get_records(self, i, j):
+        """Get records i to j (exclusive)"""
+        j = min(j, len(self))
+        if j <= i:
+            return []
+        start = self.attr.dataoffset + i * self.attr.recsize
+        length = (j - i) * self.attr.recsize
+        if length > mmap.PAGESIZE:
+            # prefetch larger ranges, the map is advised for random access
+            _madvise(self.mm, 'MADV_WILLNEED', start, length)
+        buf = self.mm[start:start + length]
+        # decode column-wise, map and zip keep the loops in C
+        columns = zip(*self._struct.iter_unpack(buf))
+        return list(zip(*(column if decode is None else map(decode, column)
+                          for decode, column in zip(self._decoders, columns))))
+
+    def _keycolumn(self):
+        """Return keys of all records as contiguous bytes"""
+        start = self.attr.dataoffset
+        stop = start + len(self) * self.attr.recsize
+        size = self._keystruct.size
+        mm = self.mm
+        return b''.join([mm[i:i + size]
+                         for i in range(start, stop, self.attr.recsize or 1)])
+
+    def _decode_keys(self, column):
+        """Return list of keys unpacked and decoded from key column"""
+        if self._keystruct.size == 0:
+            keys = [b''] * len(self)
+        else:
+            keys = [key for key, in self._keystruct.iter_unpack(column)]
+        decode = self._decoders[0]
+        return keys if decode is None else list(map(decode, keys))
+
+    def _keyindex(self):
+        """Return sorted list of all keys, read it on first call"""
+        if self._keys is not None:
+            return self._keys
+        if self.keyindex != 'file':
+            self._keys = self._decode_keys(self._keycolumn())
+            return self._keys
+        # the index file holds the version of the data file and key column
+        stat = os.fstat(self.f.fileno())
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino,
+                   self.attr.dataoffset, self.attr.recsize)
+        fname = self.attr.fname + '.keyidx'
+        try:
+            with open(fname, 'rb') as f:
+                buf = f.read()
+        except OSError:
+            buf = b''
+        keys = None
+        size = _KEYIDX.size + len(self) * self._keystruct.size
+        if len(buf) == size and _KEYIDX.unpack_from(buf) == version:
+            try:
+                keys = self._decode_keys(memoryview(buf)[_KEYIDX.size:])
+            except ValueError:
+                pass
+        if keys is None:
+            column = self._keycolumn()
+            keys = self._decode_keys(column)
+            try:
+                with open(fname, 'wb') as f:
+                    f.write(_KEYIDX.pack(*version))
+                    f.write(column)
+            except OSError:
+                warn(f'Cannot write key index file {fname}')
+        self._keys = keys
+        return self._keys
 
     def search(self, key, first=True):
         """Search for key and return the record number
@@ -195,8 +368,23 @@ class BinarySearchFile():
         :param first: Wether too search for first or last occurence"""
         with self._open():
             self.read_header()
-            recnum = _binarysearch(self._get_key, key, len(self), left=first)
-            if key != self._get_key(recnum):
+            if self.keyindex:
+                keys = self._keyindex()
+                if first:
+                    recnum = bisect_left(keys, key)
+                else:
+                    recnum = bisect_right(keys, key) - 1
+                get_key = keys.__getitem__
+            else:
+                # the found record is usually probed during the search
+                cache = {}
+
+                def get_key(i):
+                    if i not in cache:
+                        cache[i] = self._get_key(i)
+                    return cache[i]
+                recnum = _binarysearch(get_key, key, len(self), left=first)
+            if not 0 <= recnum < len(self) or key != get_key(recnum):
                 raise ValueError(f'Key {key} not present in index')
         return recnum
 
@@ -214,90 +402,152 @@ class BinarySearchFile():
     def getall(self, key):
         """Search for key and return all records with this key"""
         with self._open():
-            recnum = self.search(key)
-            alldata = []
-            fkey = key
-            while key == fkey:
-                alldata.append(self._get_data(recnum))
-                recnum += 1
-                fkey = self._get_key()
-            return alldata
+            self.read_header()
+            if self.keyindex:
+                # the end of the range is searched right of its start
+                keys = self._keyindex()
+                i = bisect_left(keys, key)
+                j = bisect_right(keys, key, i)
+                if i == j:
+                    raise ValueError(f'Key {key} not present in index')
+                return self._get_records(i, j)
+            i = self.search(key)
+            j = self.search(key, first=False)
+            return self._get_records(i, j + 1)
 
     def read(self, item=None):
         """Read and return all records"""
         with self._open():
             self.read_header()
             if item is None:
-                self.f.seek(self.attr.dataoffset)
-                return [self._get_data() for _ in range(len(self))]
+                return self._get_records(0, len(self))
             elif isinstance(item, int):
-                self.f.seek(self.attr.dataoffset + item * self.attr.recsize)
-                return self._get_data()
-            i, j = item
-            self.f.seek(self.attr.dataoffset + i * self.attr.recsize)
-            return [self._get_data() for _ in range(i, j)]
-
-    def write(self, data, header=b''):
-        """Recreate file and write data records
-
-        :param header: additional bytes appended to class property headerstart"""
-        with open(self.attr.fname, 'wb') as f:
+                if not 0 <= item < len(self):
+                    raise IndexError('record index out of range')
+                return self._get_data(item)
+            return self._get_records(*item)
+
+    def _sizes(self, data):
+        """Return field sizes needed to store data records"""
+        n = len(self.record)
+        if any(len(d) != n for d in data):
+            raise ValueError(f'Records need {n} fields')
+        columns = list(zip(*data))
+        size = []
+        for i, num in enumerate(self.record):
+            len_ = self.DTYPE[num].len
+            if isinstance(len_, int):
+                s = len_
+            elif len(columns) == 0:
+                s = 0
+            else:
+                s = max(map(len_, columns[i]))
+            size.append(s)
+        return size
+
+    def _iter_records(self, chunksize=CHUNKSIZE):
+        """Iterate over all records, read them in chunks"""
+        n = len(self)
+        for i in range(0, n, chunksize):
+            yield from self._get_records(i, min(i + chunksize, n))
+
+    def _write(self, fname, data, size, header, chunksize=CHUNKSIZE):
+        """Write header and sorted data records with given field sizes"""
+        with open(fname, 'wb') as f:
             f.write(self.magic)
             f.write(b'    ')  # reserve 4 bytes for metaoffset and dataoffset
-            f.write(self.headerstart + header)
+            f.write(header)
             metaoffset = f.tell()
 
             f.write(len(self.record).to_bytes(2))
-            size = []
-            if len(data) == 0:
-                for i in range(len(self.record)):
-                    num = self.record[i]
-                    len_ = self.DTYPE[num].len
-                    if isinstance(len_, int):
-                        s = len_
-                    else:
-                        s = 0
-                    size.append(s)
-                    f.write(num.to_bytes(1))
-                    f.write(s.to_bytes(2))
-            else:
-                for i, d in enumerate(zip(*sorted(data))):
-                    num = self.record[i]
-                    len_ = self.DTYPE[num].len
-                    if isinstance(len_, int):
-                        s = len_
-                    else:
-                        s = max(len_(d1) for d1 in d)
-                    size.append(s)
-                    f.write(num.to_bytes(1))
-                    f.write(s.to_bytes(2))
+            for num, s in zip(self.record, size):
+                f.write(num.to_bytes(1))
+                f.write(s.to_bytes(2))
             dataoffset = f.tell()
             f.seek(len(self.magic))
             f.write(metaoffset.to_bytes(2))
             f.write(dataoffset.to_bytes(2))
             f.seek(dataoffset)
 
-            for d in sorted(data):
-                for i, field in enumerate(d):
-                    encode = self.DTYPE[self.record[i]].encode
-                    f.write(encode(field, size[i]))
+            rstruct, encoders, _ = self._codecs(size)
+            pack_into = rstruct.pack_into
+            data = iter(data)
+            while chunk := list(islice(data, chunksize)):
+                # encode column-wise, then pack records into one buffer
+                columns = zip(*chunk)
+                columns = [column if encode is None else
+                           map(encode, column, repeat(s))
+                           for encode, column, s in zip(encoders, columns, size)]
+                buf = bytearray(len(chunk) * rstruct.size)
+                for i, fields in enumerate(zip(*columns)):
+                    pack_into(buf, i * rstruct.size, *fields)
+                f.write(buf)
+
+    def _reset(self):
         self.attr = _Attr(fname=self.attr.fname)
         self.header = None
+        self._keys = None
+        if self.keyindex == 'file':
+            # do not rely on timestamps for outdated key index files
+            with suppress(OSError):
+                os.remove(self.attr.fname + '.keyidx')
+
+    def _rewrite(self, data, size, header, was_open):
+        """Write records to a new file which replaces the data file
+
+        Memory maps of the old file stay valid. The file is opened again,
+        if it was opened before."""
+        fname = self.attr.fname
+        try:
+            if not os.path.exists(fname):
+                self._write(fname, data, size, header)
+            else:
+                fd, tmpfname = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(fname)))
+                os.close(fd)
+                try:
+                    self._write(tmpfname, data, size, header)
+                    shutil.copymode(fname, tmpfname)
+                    # the map needs to be closed before replacing on Windows
+                    self.close()
+                    os.replace(tmpfname, fname)
+                except BaseException:
+                    with suppress(OSError):
+                        os.remove(tmpfname)
+                    raise
+            self._reset()
+        finally:
+            if was_open:
+                self.open()
+
+    def write(self, data, header=b''):
+        """Recreate file and write data records
+
+        :param header: additional bytes appended to class property headerstart"""
+        was_open = self.f is not None
+        data = sorted(data)
+        self._rewrite(data, self._sizes(data), self.headerstart + header,
+                      was_open)
 
     def update(self, data, header=None):
         """Update file with data records
 
-        Note: The whole file is read and recreated from scratch to guarantee
-        the correct sorting.
+        Note: The file is recreated from scratch. The sorted records of the
+        file are merged with the sorted new records.
 
         :param header: additional bytes appended to class property headerstart
         """
-        odata = self.read()
-        if header is None:
-            header = self.header
-        else:
-            header = self.headerstart + header
-        return self.write(odata + data, header=header)
+        was_open = self.f is not None
+        with self._open():
+            self.read_header()
+            if header is None:
+                header = self.header
+            else:
+                header = self.headerstart + header
+            data = sorted(data)
+            size = list(map(max, self.size, self._sizes(data)))
+            self._rewrite(merge(self._iter_records(), data), size,
+                          self.headerstart + header, was_open)
 
     def __str__(self):
         if not os.path.exists(self.attr.fname):
@@ -352,17 +602,13 @@ class BinarySequentialFile():
         if not self._check_magic():
             warn(f'Wrong magic bytes in file {self.attr.fname}')
         # overide class attributes
-        self.attr.metaoffset = _rint(f, 2)
-        self.attr.dataoffset = _rint(f, 2)
+        self.attr.metaoffset, self.attr.dataoffset = _OFFSETS.unpack(
+            f.read(_OFFSETS.size))
         self.header = f.read(self.attr.metaoffset - len(self.magic) - 4)
-        assert f.tell() == self.attr.metaoffset
-        self.attr.reclen = _rint(f, 2)
-        self.record = []
-        self.size = []
-        for i in range(self.attr.reclen):
-            self.record.append(_rint(f, 1))
-            self.size.append(_rint(f, 2))
+        meta = f.read(self.attr.dataoffset - self.attr.metaoffset)
+        self.attr.reclen, self.record, self.size = _parse_meta(meta)
         self.attr.recsize = sum(self.size)
+        self._set_codecs()
         if not self._sizecheck():
             warn(f'The size of file {self.attr.fname} is inconsistent')
 
@@ -382,12 +628,17 @@ class BinarySequentialFile():
             f.write(num.to_bytes(1))
             f.write(s.to_bytes(2))
         attr.recsize = sum(self.size)
+        self._set_codecs()
         attr.dataoffset = f.tell()
         f.seek(len(self.magic))
         f.write(attr.metaoffset.to_bytes(2))
         f.write(attr.dataoffset.to_bytes(2))
         f.seek(attr.dataoffset)
 
+    def _set_codecs(self):
+        self._encoders = tuple(self.DTYPE[num].encode for num in self.record)
+        self._decoders = tuple(self.DTYPE[num].decode for num in self.record)
+
     def open(self):
         exists_before = os.path.exists(self.attr.fname)
         if not exists_before:
@@ -411,8 +662,9 @@ class BinarySequentialFile():
     def _get_data(self, i=None):
         if i is not None:
             self.f.seek(self.attr.dataoffset + i * self.attr.recsize)
-        return tuple(self.DTYPE[record].decode(self.f.read(size))
-                     for record, size in zip(self.record, self.size))
+        read = self.f.read
+        return tuple(decode(read(size))
+                     for decode, size in zip(self._decoders, self.size))
 
     def __getitem__(self, item):
         return self.read(item)
@@ -442,9 +694,11 @@ class BinarySequentialFile():
         """Write record at specified or next position"""
         if i is not None:
             self.f.seek(self.attr.dataoffset + i * self.attr.recsize)
-        for i, field in enumerate(data):
-            encode = self.DTYPE[self.record[i]].encode
-            self.f.write(encode(field, self.size[i]))
+        if len(data) != len(self.record):
+            raise ValueError(f'Record needs {len(self.record)} fields')
+        write = self.f.write
+        for encode, field, size in zip(self._encoders, data, self.size):
+            write(encode(field, size))
 
     def __str__(self):
         return (f'{type(self).__name__}\n'
@@ -1,5 +1,6 @@
 # (C) 2024, Tom Eulenfeld, MIT license
 
+import os
 from os.path import join
 from tempfile import TemporaryDirectory
 import unittest
@@ -21,8 +22,15 @@ class BinarySearchFileTestCase(unittest.TestCase):
             self.assertEqual(len(bsf.read()), len(bsf))
             self.assertEqual(bsf.read(0), ('test1', 3))
             self.assertEqual(len(bsf.read((0, 2))), 2)
+            os.chmod(path, 0o600)
             bsf.update([('test99', 1)])
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
             self.assertEqual(len(bsf), 6)
+            bsf.update([('test100', 1), ('test0', 1)])
+            self.assertEqual(
+                bsf.read(),
+                sorted(data + [('test99', 1), ('test100', 1), ('test0', 1)]))
+            self.assertEqual(bsf.size[0], 7)
             self.assertIn('size', str(bsf))
             # print(bsf['testX'])
             with self.assertRaises(ValueError):
@@ -32,6 +40,19 @@ class BinarySearchFileTestCase(unittest.TestCase):
             self.assertFalse(
                 BinarySearchFile.check_magic(join(tmpdir, 'none')))
 
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['test.bsf'])
+            # key index files are only removed with keyindex = 'file'
+            open(path + '.keyidx', 'wb').close()
+            bsf.update([])
+            self.assertTrue(os.path.exists(path + '.keyidx'))
+            os.remove(path + '.keyidx')
+
+            bsf.write(data)
+            bsf2 = BinarySearchFile(path)
+            self.assertEqual(len(bsf2), len(data))
+            bsf.write(data + [('test5', 1)])
+            self.assertEqual(len(bsf2), len(data) + 1)
+
             bsf = BinarySearchFile(path + 'x')
             self.assertIn('does not exist', str(bsf))
 
@@ -43,6 +64,94 @@ class BinarySearchFileTestCase(unittest.TestCase):
             with self.assertWarnsRegex(UserWarning, 'Wrong magic'):
                 self.assertEqual(bsf['test3'], ('test3', 5))
 
+    def test_contextmanager(self):
+        data = [('test1', 3), ('test4', 6), ('test2', 1), ('test3', 10)]
+        with TemporaryDirectory() as tmpdir:
+            path = join(tmpdir, 'test.bsf')
+            BinarySearchFile(path).write(data)
+            with BinarySearchFile(path) as bsf:
+                mm = bsf.mm
+                for d in data:
+                    self.assertEqual(bsf[d[0]], d)
+                self.assertEqual(len(bsf.read()), 4)
+                self.assertIs(bsf.mm, mm)
+                bsf.update([('test5', 1)])
+                self.assertEqual(bsf['test5'], ('test5', 1))
+                bsf.write(data[:1])
+                self.assertEqual(bsf.read(), data[:1])
+                self.assertIsNotNone(bsf.mm)
+                with self.assertRaises(TypeError):
+                    bsf.write([('test1', 1), (2, 'test2')])
+                self.assertIsNotNone(bsf.mm)
+            # other objects keep a valid map of the old file
+            data = [(f'test{i:05d}', i) for i in range(10000)]
+            BinarySearchFile(path).write(data)
+            with BinarySearchFile(path) as bsf:
+                BinarySearchFile(path).write(data[:1])
+                self.assertEqual(bsf.read((9999, 10000)), data[-1:])
+            self.assertIsNone(bsf.mm)
+            self.assertTrue(mm.closed)
+            bsf.open()
+            mm = bsf.mm
+            bsf.open()
+            self.assertIs(bsf.mm, mm)
+            bsf.close()
+            self.assertTrue(mm.closed)
+            with open(path, 'wb') as f:
+                f.write(b'\xfe\xfe\x01\x01\x00\x08\x00\x10')
+            bsf = BinarySearchFile(path)
+            with self.assertRaises(Exception):
+                with bsf:
+                    pass
+            self.assertIsNone(bsf.f)
+            self.assertIsNone(bsf.mm)
+
+    def test_keyindex(self):
+        class MyBinarySearchFile(BinarySearchFile):
+            record = (50, 50)
+            keyindex = True
+        data = [(k, i) for i, k in enumerate([1, 3, 3, 3, 5, 8, 8, 13, 21])]
+        with TemporaryDirectory() as tmpdir:
+            path = join(tmpdir, 'test.bsf')
+            bsf = MyBinarySearchFile(path)
+            bsf.write(data)
+            for k in set(k for k, _ in data):
+                recnums = [i for i, (k2, _) in enumerate(data) if k2 == k]
+                self.assertEqual(bsf.search(k), recnums[0])
+                self.assertEqual(bsf.search(k, first=False), recnums[-1])
+            self.assertEqual(bsf.getall(3), data[1:4])
+            for k in (0, 4, 22):
+                with self.assertRaises(ValueError):
+                    bsf[k]
+            bsf.update([(4, 9)])
+            self.assertEqual(bsf[4], (4, 9))
+            bsf.write([])
+            with self.assertRaises(ValueError):
+                bsf[4]
+
+    def test_keyindex_file(self):
+        class MyBinarySearchFile(BinarySearchFile):
+            record = (50, 50)
+            keyindex = 'file'
+        with TemporaryDirectory() as tmpdir:
+            path = join(tmpdir, 'test.bsf')
+            bsf = MyBinarySearchFile(path)
+            bsf.write([(1, 1), (2, 2), (2, 3)])
+            self.assertEqual(bsf.search(2), 1)
+            self.assertTrue(os.path.exists(path + '.keyidx'))
+            self.assertEqual(MyBinarySearchFile(path).getall(2),
+                             [(2, 2), (2, 3)])
+            bsf.write([(1, 1), (3, 2), (4, 3)])
+            bsf = MyBinarySearchFile(path)
+            self.assertEqual(bsf.search(4), 2)
+            with self.assertRaises(ValueError):
+                bsf.search(2)
+            self.assertEqual(BinarySearchFile(path).search(4), 2)
+            for content in (b'', b'garbage', bytes(40 + 3)):
+                with open(path + '.keyidx', 'wb') as f:
+                    f.write(content)
+                self.assertEqual(MyBinarySearchFile(path).search(4), 2)
+
     def test_inheritance(self):
         class MyBinarySearchFile(BinarySearchFile):
             magic = b'\xfe\xff\x01\x01'
@@ -81,6 +190,29 @@ class BinarySearchFileTestCase(unittest.TestCase):
             self.assertEqual(len(bsf), len(data))
             bsf.write([])
             self.assertEqual(len(bsf), 0)
+        data = [(2**30, -2**62, 255), (2**31, 2**39, 0)]
+        with TemporaryDirectory() as tmpdir:
+            path = join(tmpdir, 'test.bsf')
+            bsf = MyBinarySearchFile(path)
+            bsf.write(data)
+            self.assertEqual(bsf.read(), data)
+            self.assertEqual(bsf.size, [4, 8, 1])
+            self.assertEqual(bsf.get(2**31), data[1])
+            with self.assertRaises(IndexError):
+                bsf.read(2)
+
+    def test_strtypes(self):
+        class MyBinarySearchFile(BinarySearchFile):
+            record = (20, 10, 0)
+        data = [('Zürich', 'Zurich', b'ZH'), ('Bern', 'Bern', b'BE'),
+                ('Genève', 'Gen\xe8ve', b'GE')]
+        with TemporaryDirectory() as tmpdir:
+            path = join(tmpdir, 'test.bsf')
+            bsf = MyBinarySearchFile(path)
+            bsf.write(data)
+            self.assertEqual(bsf.read(), sorted(data))
+            self.assertEqual(bsf.size, [7, 6, 2])
+            self.assertEqual(bsf['Zürich'], data[0])
 
     def test_newtypes(self):
         class MyBinarySearchFile(BinarySearchFile):
@@ -98,6 +230,19 @@ class BinarySearchFileTestCase(unittest.TestCase):
             self.assertEqual(bsf.get(100), (100,))
             self.assertEqual(bsf.size[0], 5)
 
+    def test_wrong_fields(self):
+        with TemporaryDirectory() as tmpdir:
+            path = join(tmpdir, 'test.bsf')
+            bsf = BinarySearchFile(path)
+            bsf.write([('a', 1)])
+            with self.assertRaises(ValueError):
+                bsf.write([('a', 1, 'extra'), ('b', 2, 'x')])
+            with self.assertRaises(ValueError):
+                bsf.update([('b', 2, 'extra')])
+            with self.assertRaises(ValueError):
+                bsf.update([('b',)])
+            self.assertEqual(bsf.read(), [('a', 1)])
+
     def test_seqfile(self):
         with TemporaryDirectory() as tmpdir:
             path = join(tmpdir, 'test.bsf')
@@ -108,6 +253,8 @@ class BinarySearchFileTestCase(unittest.TestCase):
                 self.assertEqual(b[0], ('test', 10))
                 b.write(('test2', 11))
                 b[0] = ('test1', 12)
+                with self.assertRaises(ValueError):
+                    b[1] = ('test1', 12, 'extra')
                 data = [('test1', 12), ('test2', 11)]
                 self.assertEqual(b.read(), data)
                 self.assertIn('size', str(b))